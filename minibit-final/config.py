@@ -18,6 +18,12 @@ TOTAL_BLOCKS = None
 UNCHOKE_INTERVAL = 10  # seconds
 MAX_UNCHOKED = 4
 OPTIMISTIC_UNCHOKE = 1
+BLOCKS_PER_REQUEST = 4  # blocks asked from one peer in a single message
+IDLE_TIMEOUT = 30  # seconds an accepted peer connection may sit unused before it is closed
+
+# How long a peer's block list stays valid in the local cache
+LIST_TTL = 5  # seconds
+LIST_SCAN_TIMEOUT = 3  # seconds to wait for block lists before using what has arrived
 
 # Peer base port (peer 0 = 9000, peer 1 = 9001, etc.)
 PEER_PORT_BASE = 9000
@@ -4,15 +4,23 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 import socket
 import threading
-import pickle
+import json
+import heapq
+import queue
 import random
 import time
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FuturesTimeoutError
 from config import FILE_NAME
 
 
 from config import *
-from utils.utils import assemble_file
+from utils.utils import assemble_file, tune_socket, pack_frame, send_frame, send_file_frame, recv_frame
+from utils.utils import MSG_LIST, MSG_BLOCK_LIST, MSG_BLOCK_REQUEST, MSG_BLOCK_REQUEST_BATCH, MSG_BLOCK, MSG_CHOKED
+from utils.utils import MSG_ANNOUNCE, unpack_ports, pack_bitfield, unpack_bitfield, PORT
+
+# Room for a full batch of blocks in each direction
+SOCKET_BUFFER = 2 * BLOCK_SIZE * BLOCKS_PER_REQUEST
 
 class Peer:
     def __init__(self, peer_id, total_blocks, initial_blocks):
@@ -20,12 +28,23 @@ class Peer:
         self.port = PEER_PORT_BASE + peer_id
         self.blocks = set(initial_blocks)
         self.total_blocks = total_blocks
-        self.peers_known = set()
+        self.needed = set(range(total_blocks)) - self.blocks
+        self._block_list_frame = None  # encoded MSG_BLOCK_LIST reply, rebuilt after self.blocks changes
+        self.peers_known = frozenset()  # replaced on every change so readers need no lock
         self.allowed_peers = set()
         self.optimistic_peer = None
+        self._unchoked_ports = frozenset()  # allowed_peers plus optimistic_peer, replaced as a whole
         self.blocked_by = set()
-        self.running = True
+        self._peer_blocks_cache = {}  # peer_port -> (timestamp, set of blocks)
+        self._block_counts = Counter()  # replicas per block across cached lists, kept in step with the cache
+        self._conn_pool = {}  # peer_port -> LifoQueue of idle sockets
+        self._tracker_sock = None  # kept open between announces
+        self._tracker_lock = threading.Lock()  # guards _tracker_sock
+        self._list_executor = ThreadPoolExecutor(max_workers=32)
+        self._stop_event = threading.Event()  # set by stop(); loops wait on it instead of sleeping
         self.lock = threading.Lock()
+        self._peer_names = {}  # peer_port -> 'P<id>' for logs
+        self._log_clock = (None, '')  # (epoch second, formatted timestamp)
         self.log_file = open(f'logs/peer-{self.peer_id}-{FILE_NAME}.log', 'w')
 
         os.makedirs('logs', exist_ok=True)
@@ -33,12 +52,22 @@ class Peer:
         self.write_log(f'Started with {len(self.blocks)} blocks.')
 
     def write_log(self, message):
-        timestamp = time.strftime('%Y-%m-%d %H:%M:%S')
+        second = int(time.time())
+        cached_second, timestamp = self._log_clock
+        if second != cached_second:
+            timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(second))
+            self._log_clock = (second, timestamp)
         log_entry = f'[{timestamp}] [Peer {self.peer_id}] {message}'
         print(log_entry)
         self.log_file.write(log_entry + '\n')
         self.log_file.flush()
 
+    def _peer_name(self, port):
+        name = self._peer_names.get(port)
+        if name is None:
+            name = self._peer_names[port] = f'P{port - PEER_PORT_BASE}'
+        return name
+
     def start_server(self):
         threading.Thread(target=self._server_loop, daemon=True).start()
 
@@ -47,123 +76,246 @@ class Peer:
             server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             server_socket.bind((TRACKER_HOST, self.port))
             server_socket.listen()
-            while self.running:
+            server_socket.settimeout(1.0)  # wake up regularly to notice stop()
+            while not self._stop_event.is_set():
                 try:
                     conn, _ = server_socket.accept()
+                    conn.settimeout(IDLE_TIMEOUT)  # drop pooled connections the client stopped using
+                    tune_socket(conn, SOCKET_BUFFER)
                     threading.Thread(target=self._handle_request, args=(conn,), daemon=True).start()
+                except socket.timeout:
+                    continue
                 except OSError:
                     break
 
     def _handle_request(self, connection):
         try:
-            request = pickle.loads(connection.recv(4096))
-            if request['type'] == 'list':
-                connection.sendall(pickle.dumps(list(self.blocks)))
-            elif request['type'] == 'block_request':
-                requester_port = request['requester_port']
-                block_id = request['block_id']
-                with self.lock:
-                    allowed = (requester_port in self.allowed_peers) or (requester_port == self.optimistic_peer)
-                if allowed and block_id in self.blocks:
-                    with open(f'files/blocks/{FILE_NAME}_block_{block_id}', 'rb') as f:
-                        connection.sendall(pickle.dumps(f.read()))
+            while (frame := recv_frame(connection)) is not None:
+                msg_type, payload = frame
+                if msg_type == MSG_LIST:
+                    with self.lock:
+                        if self._block_list_frame is None:
+                            self._block_list_frame = pack_frame(MSG_BLOCK_LIST, pack_bitfield(self.blocks, self.total_blocks))
+                        frame = self._block_list_frame
+                    connection.sendall(frame)
+                elif msg_type == MSG_BLOCK_REQUEST:
+                    request = json.loads(payload)
+                    self._send_block(connection, request['block_id'], self._is_unchoked(request['requester_port']))
+                elif msg_type == MSG_BLOCK_REQUEST_BATCH:
+                    request = json.loads(payload)
+                    allowed = self._is_unchoked(request['requester_port'])
+                    for block_id in request['block_ids']:
+                        self._send_block(connection, block_id, allowed)
                 else:
-                    connection.sendall(pickle.dumps(b'CHOKED'))
+                    break  # unknown message: close so the client isn't left waiting for a reply
         except Exception:
             pass
         finally:
             connection.close()
 
-    def _connect_peer(self, peer_port, message):
+    def _send_block(self, connection, block_id, allowed):
+        if allowed and block_id in self.blocks:
+            with open(f'files/blocks/{FILE_NAME}_block_{block_id}', 'rb') as f:
+                send_file_frame(connection, MSG_BLOCK, f)
+        else:
+            send_frame(connection, MSG_CHOKED)
+
+    def _is_unchoked(self, requester_port):
+        # Reading the attribute is atomic, so uploads never wait on self.lock.
+        return requester_port in self._unchoked_ports
+
+    def _set_unchoked(self, allowed, optimistic):
+        # Caller holds self.lock.
+        self.allowed_peers = allowed
+        self.optimistic_peer = optimistic
+        self._unchoked_ports = frozenset(allowed | {optimistic} if optimistic else allowed)
+
+    def _acquire(self, peer_port):
+        with self.lock:
+            pool = self._conn_pool.setdefault(peer_port, queue.LifoQueue())
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-                sock.settimeout(2)
+            return pool.get_nowait(), True
+        except queue.Empty:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.settimeout(2)
+            tune_socket(sock, SOCKET_BUFFER)
+            try:
                 sock.connect((TRACKER_HOST, peer_port))
-                sock.sendall(pickle.dumps(message))
-                return pickle.loads(sock.recv(65536))
-        except Exception:
-            return None
+            except OSError:
+                sock.close()
+                raise
+            return sock, False
+
+    def _release(self, peer_port, sock):
+        with self.lock:
+            pool = self._conn_pool.setdefault(peer_port, queue.LifoQueue())
+        pool.put(sock)
+
+    def _connect_peer(self, peer_port, msg_type, message=None, replies=1):
+        payload = json.dumps(message).encode() if message is not None else b''
+        while True:
+            try:
+                sock, reused = self._acquire(peer_port)
+            except OSError:
+                return None
+            try:
+                send_frame(sock, msg_type, payload)
+                frames = [recv_frame(sock) for _ in range(replies)]
+            except Exception:
+                frames = [None]
+            if None not in frames:
+                self._release(peer_port, sock)
+                return frames
+            sock.close()
+            # A pooled socket may have been closed by the other side; retry on a fresh one.
+            if not reused:
+                return None
 
     def contact_tracker(self):
-        try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-                sock.settimeout(5)
-                sock.connect((TRACKER_HOST, TRACKER_PORT))
-                sock.sendall(pickle.dumps(self.port))
-                peers = pickle.loads(sock.recv(4096))
-                with self.lock:
-                    self.peers_known.update(peers)
-        except Exception:
-            self.write_log('Tracker is offline.')
+        with self._tracker_lock:
+            while not self._stop_event.is_set():
+                reused = self._tracker_sock is not None
+                try:
+                    if not reused:
+                        self._tracker_sock = socket.create_connection((TRACKER_HOST, TRACKER_PORT), timeout=5)
+                        tune_socket(self._tracker_sock)  # announces are tiny; default buffers suffice
+                        if self._stop_event.is_set():  # stop() ran while connecting and missed this socket
+                            raise ConnectionError('peer is stopping')
+                    send_frame(self._tracker_sock, MSG_ANNOUNCE, PORT.pack(self.port))
+                    frame = recv_frame(self._tracker_sock)
+                    if frame is None:
+                        raise ConnectionError('tracker closed the connection')
+                    peers = unpack_ports(frame[1])
+                    with self.lock:
+                        self.peers_known = self.peers_known.union(peers)
+                    return
+                except Exception:
+                    if self._tracker_sock is not None:
+                        self._tracker_sock.close()
+                        self._tracker_sock = None
+                    if self._stop_event.is_set():
+                        return
+                    # The tracker may have dropped the kept connection; retry once on a fresh one.
+                    if not reused:
+                        self.write_log('Tracker is offline.')
+                        return
 
-    def _get_blocks_in_network(self):
-        block_counts = Counter()
-        peer_blocks = {}
+    def _get_peer_blocks_cached(self, peer_port, now, refresh=False):
+        if not refresh:
+            with self.lock:
+                cached = self._peer_blocks_cache.get(peer_port)
+            if cached is not None and now - cached[0] < LIST_TTL:
+                return cached[1]
+        frames = self._connect_peer(peer_port, MSG_LIST)
         with self.lock:
-            peers_copy = self.peers_known.copy()
+            cached = self._peer_blocks_cache.pop(peer_port, None)
+            old_blocks = cached[1] if cached is not None else set()
+            if frames is None:
+                self._count_replicas(old_blocks, set())
+                return None
+            blocks = unpack_bitfield(frames[0][1])
+            if blocks == old_blocks:
+                blocks = old_blocks
+            else:
+                self._count_replicas(old_blocks, blocks)
+            self._peer_blocks_cache[peer_port] = (now, blocks)
+        return blocks
+
+    def _count_replicas(self, old_blocks, new_blocks):
+        # Caller holds self.lock. Blocks nobody has are dropped so lookups see them as missing.
+        self._block_counts.update(new_blocks - old_blocks)
+        for block in old_blocks - new_blocks:
+            self._block_counts[block] -= 1
+            if not self._block_counts[block]:
+                del self._block_counts[block]
 
-        for peer_port in peers_copy:
-            if peer_port == self.port:
+    def _get_blocks_in_network(self, refresh=False):
+        peer_blocks = {}
+        now = time.monotonic()  # TTL ages must not jump with the wall clock
+        futures = {}
+        for peer_port in self.peers_known:
+            if peer_port == self.port or self._stop_event.is_set():
                 continue
-            blocks = self._connect_peer(peer_port, {'type': 'list'})
-            if blocks is not None:
-                peer_blocks[peer_port] = set(blocks)
-                block_counts.update(blocks)
-            else:
-                with self.lock:
-                    self.peers_known.discard(peer_port)
-        return block_counts, peer_blocks
+            try:
+                futures[self._list_executor.submit(self._get_peer_blocks_cached, peer_port, now, refresh)] = peer_port
+            except RuntimeError:
+                break  # stop() shut the executor down meanwhile
+        try:
+            for future in as_completed(futures, timeout=LIST_SCAN_TIMEOUT):
+                peer_port = futures[future]
+                blocks = future.result()
+                if blocks is not None:
+                    peer_blocks[peer_port] = blocks
+                else:
+                    with self.lock:
+                        self.peers_known = self.peers_known - {peer_port}
+        except FuturesTimeoutError:
+            # Peers still answering are left out of this scan; their lookups finish in the background.
+            pass
+        # A lookup racing a removal can re-cache a dropped peer; forget it so its blocks aren't counted.
+        with self.lock:
+            known = self.peers_known
+            for peer_port in [port for port in self._peer_blocks_cache if port not in known]:
+                self._count_replicas(self._peer_blocks_cache.pop(peer_port)[1], set())
+        # Callers only look up counts, which is safe while other threads update them.
+        return self._block_counts, peer_blocks
 
     def _select_rarest_block(self, block_counts):
-        needed = set(range(self.total_blocks)) - self.blocks
-        if not needed:
-            return None
-        rarity = {b: block_counts[b] for b in needed if b in block_counts}
-        if not rarity:
-            return None
-        min_count = min(rarity.values())
-        candidates = [b for b, count in rarity.items() if count == min_count]
-        return random.choice(candidates)
+        min_count = None
+        candidates = []
+        for b in self.needed:
+            count = block_counts.get(b)
+            if count is None:
+                continue
+            if min_count is None or count < min_count:
+                min_count = count
+                candidates = [b]
+            elif count == min_count:
+                candidates.append(b)
+        return random.choice(candidates) if candidates else None
+
+    def _select_batch(self, target, has_blocks, block_counts):
+        extra = heapq.nsmallest(BLOCKS_PER_REQUEST - 1, (self.needed & has_blocks) - {target}, key=block_counts.__getitem__)
+        return [target] + extra
 
     def update_peers_loop(self):
-        while self.running:
-            time.sleep(UNCHOKE_INTERVAL)
+        while not self._stop_event.wait(UNCHOKE_INTERVAL):
             if not self.peers_known:
                 continue
-            _, peer_blocks = self._get_blocks_in_network()
-            needed_blocks = set(range(self.total_blocks)) - self.blocks
+            _, peer_blocks = self._get_blocks_in_network(refresh=True)
             with self.lock:
+                needed_blocks = self.needed.copy()
                 self.blocked_by.clear()
+                # Taken after the clear, as the original per-peer reads saw it: chokes from
+                # the previous round don't carry over into this ranking.
+                blocked = frozenset(self.blocked_by)
                 if not needed_blocks:
-                    selected = random.sample(list(self.peers_known - {self.port}), min(MAX_UNCHOKED, len(self.peers_known - {self.port})))
-                    self.allowed_peers = set(selected)
-                    self.optimistic_peer = None
+                    other_peers = list(self.peers_known - {self.port})
+                    selected = random.sample(other_peers, min(MAX_UNCHOKED, len(other_peers)))
+                    self._set_unchoked(set(selected), None)
                     continue
             scores = {}
             for port, has_blocks in peer_blocks.items():
-                with self.lock:
-                    if port in self.blocked_by:
-                        scores[port] = -1
-                        continue
+                if port in blocked:
+                    scores[port] = -1
+                    continue
                 scores[port] = len(needed_blocks.intersection(has_blocks))
-            ranked_peers = sorted(scores.keys(), key=lambda p: scores[p], reverse=True)
-            new_allowed = set(ranked_peers[:MAX_UNCHOKED])
-            choked_peers = [p for p in ranked_peers if p not in new_allowed]
+            new_allowed = set(heapq.nlargest(MAX_UNCHOKED, scores, key=scores.get))
+            choked_peers = [p for p in scores if p not in new_allowed]
             optimistic = random.choice(choked_peers) if choked_peers else None
             with self.lock:
-                self.allowed_peers = new_allowed
-                self.optimistic_peer = optimistic
-            allowed_names = sorted([f'P{p-PEER_PORT_BASE}' for p in new_allowed])
-            opt_name = f'P{optimistic-PEER_PORT_BASE}' if optimistic else "None"
+                self._set_unchoked(new_allowed, optimistic)
+            allowed_names = sorted([self._peer_name(p) for p in new_allowed])
+            opt_name = self._peer_name(optimistic) if optimistic else "None"
             self.write_log(f"New unchoked peers: {allowed_names}, optimistic: {opt_name}")
 
     def download_blocks_loop(self):
-        while len(self.blocks) < self.total_blocks:
+        while len(self.blocks) < self.total_blocks and not self._stop_event.is_set():
             block_counts, peer_blocks = self._get_blocks_in_network()
             target = self._select_rarest_block(block_counts)
             if target is None:
                 self.write_log("No needed blocks available.")
-                time.sleep(5)
+                self._stop_event.wait(5)
                 continue
             with self.lock:
                 candidates = list(self.allowed_peers)
@@ -173,29 +325,41 @@ class Peer:
             downloaded = False
             for peer_port in candidates:
                 if peer_port in peer_blocks and target in peer_blocks[peer_port]:
-                    message = {'type': 'block_request', 'block_id': target, 'requester_port': self.port}
-                    result = self._connect_peer(peer_port, message)
-                    if result and result != b'CHOKED':
-                        with open(f'files/blocks/{FILE_NAME}_block_{target}', 'wb') as f:
-                            f.write(result)
-                        with self.lock:
-                            self.blocks.add(target)
-                            percent = (100 * len(self.blocks)) // self.total_blocks
-                        self.write_log(f"Downloaded block {target} from peer {peer_port - PEER_PORT_BASE} ({percent}%)")
+                    batch = self._select_batch(target, peer_blocks[peer_port], block_counts)
+                    message = {'block_ids': batch, 'requester_port': self.port}
+                    frames = self._connect_peer(peer_port, MSG_BLOCK_REQUEST_BATCH, message, replies=len(batch))
+                    if frames is None:
+                        continue
+                    received = [(block_id, data) for block_id, (msg_type, data) in zip(batch, frames)
+                                if msg_type == MSG_BLOCK and data]
+                    if received:
+                        for block_id, data in received:
+                            # Other peers may be sending this block file; replace it instead of truncating it.
+                            block_path = f'files/blocks/{FILE_NAME}_block_{block_id}'
+                            with open(f'{block_path}.{self.peer_id}.tmp', 'wb') as f:
+                                f.write(data)
+                            os.replace(f'{block_path}.{self.peer_id}.tmp', block_path)
+                            with self.lock:
+                                self.blocks.add(block_id)
+                                self._block_list_frame = None
+                                self.needed.discard(block_id)
+                                percent = (100 * len(self.blocks)) // self.total_blocks
+                            self.write_log(f"Downloaded block {block_id} from peer {peer_port - PEER_PORT_BASE} ({percent}%)")
                         downloaded = True
                         break
-                    elif result == b'CHOKED':
+                    elif any(msg_type == MSG_CHOKED for msg_type, _ in frames):
                         self.write_log(f"Choked by peer {peer_port - PEER_PORT_BASE}")
                         with self.lock:
                             self.blocked_by.add(peer_port)
             if not downloaded:
-                time.sleep(random.uniform(1.0, 2.0))
+                self._stop_event.wait(random.uniform(1.0, 2.0))
+        if self._stop_event.is_set():
+            return
         output_path = f'files/downloads/peer-{self.peer_id}-{FILE_NAME}'
         assemble_file(sorted(list(self.blocks)), 'files/blocks', output_path, FILE_NAME)
         self.write_log(f'File saved to {output_path}. Now seeding...')
 
-        while True:
-            time.sleep(3600)
+        self._stop_event.wait()
 
     def run(self):
         self.start_server()
@@ -203,10 +367,31 @@ class Peer:
         threading.Thread(target=self.update_peers_loop, daemon=True).start()
         self.download_blocks_loop()
 
+    def stop(self):
+        self._stop_event.set()
+        self._list_executor.shutdown(wait=False)
+        # Don't wait for _tracker_lock: an announce may hold it while blocked in recv().
+        # Shutting the socket down wakes that recv(); _tracker_loop closes the socket.
+        tracker_sock = self._tracker_sock
+        if tracker_sock is not None:
+            try:
+                tracker_sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        with self.lock:
+            pools, self._conn_pool = self._conn_pool, {}
+        for pool in pools.values():
+            while not pool.empty():
+                pool.get_nowait().close()
+
     def _tracker_loop(self):
-        while self.running:
+        while not self._stop_event.is_set():
             self.contact_tracker()
-            time.sleep(TRACKER_UPDATE_INTERVAL)
+            self._stop_event.wait(TRACKER_UPDATE_INTERVAL)
+        with self._tracker_lock:
+            if self._tracker_sock is not None:
+                self._tracker_sock.close()
+                self._tracker_sock = None
 
 if __name__ == '__main__':
     if len(sys.argv) < 4:
@@ -216,4 +401,7 @@ if __name__ == '__main__':
     total_blocks = int(sys.argv[2])
     initial_blocks = list(map(int, sys.argv[3:]))
     peer = Peer(peer_id, total_blocks, initial_blocks)
-    peer.run()
+    try:
+        peer.run()
+    except KeyboardInterrupt:
+        peer.stop()
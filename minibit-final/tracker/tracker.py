@@ -2,52 +2,70 @@ import sys
 import os
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-import socket
-import threading
-import pickle
+import asyncio
 import random
 import time
 from config import TRACKER_HOST, TRACKER_PORT, TRACKER_TIMEOUT, MAX_UNCHOKED
+from utils.utils import pack_frame, pack_ports, FRAME_HEADER, PORT, MSG_ANNOUNCE, MSG_PEERS
 
+# Only touched from the event loop thread, so no lock is needed.
+# Maps port -> last announce (monotonic clock), in last-seen order: announces move a peer to the end.
 active_peers = {}
-peers_lock = threading.Lock()
+_peer_ports = None  # list(active_peers), rebuilt only after a peer joins or leaves
 
-def remove_inactive_peers():
+def peer_ports():
+    global _peer_ports
+    if _peer_ports is None:
+        _peer_ports = list(active_peers)
+    return _peer_ports
+
+async def remove_inactive_peers():
     """Remove peers that haven't checked in recently."""
+    global _peer_ports
     while True:
-        time.sleep(TRACKER_TIMEOUT / 2)
-        with peers_lock:
-            current_time = time.time()
-            to_remove = [port for port, last_seen in active_peers.items() if current_time - last_seen > TRACKER_TIMEOUT]
-            for port in to_remove:
-                del active_peers[port]
-                print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Removed inactive peer {port}")
+        await asyncio.sleep(TRACKER_TIMEOUT / 2)
+        current_time = time.monotonic()
+        # Only the expired prefix needs to be visited.
+        while active_peers:
+            port, last_seen = next(iter(active_peers.items()))
+            if current_time - last_seen <= TRACKER_TIMEOUT:
+                break
+            del active_peers[port]
+            _peer_ports = None
+            print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Removed inactive peer {port}")
 
-def handle_peer_connection(connection):
+async def handle_peer_connection(reader, writer):
+    global _peer_ports
+    # Peers keep the connection open and announce on it until they disconnect.
     try:
-        peer_port = pickle.loads(connection.recv(1024))
-        with peers_lock:
-            active_peers[peer_port] = time.time()
-        with peers_lock:
-            other_peers = list(active_peers.keys() - {peer_port})
-        num_return = min(MAX_UNCHOKED, len(other_peers))
-        selected = random.sample(other_peers, num_return)
-        connection.send(pickle.dumps(selected))
+        while True:
+            try:
+                header = await reader.readexactly(FRAME_HEADER.size)
+            except asyncio.IncompleteReadError:
+                break
+            msg_type, length = FRAME_HEADER.unpack(header)
+            if msg_type != MSG_ANNOUNCE or length != PORT.size:
+                break  # not a peer announce; don't buffer a payload of the client's choosing
+            (peer_port,) = PORT.unpack(await reader.readexactly(length))
+            if active_peers.pop(peer_port, None) is None:
+                _peer_ports = None
+            active_peers[peer_port] = time.monotonic()
+            # One extra pick covers the announcing peer, which is then dropped.
+            ports = peer_ports()
+            sample = random.sample(ports, min(MAX_UNCHOKED + 1, len(ports)))
+            selected = [port for port in sample if port != peer_port][:MAX_UNCHOKED]
+            writer.write(pack_frame(MSG_PEERS, pack_ports(selected)))
+            await writer.drain()
     except Exception:
         pass
     finally:
-        connection.close()
+        writer.close()
 
-def start_tracker():
-    threading.Thread(target=remove_inactive_peers, daemon=True).start()
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server_socket:
-        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        server_socket.bind((TRACKER_HOST, TRACKER_PORT))
-        server_socket.listen()
-        print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Tracker online at {TRACKER_HOST}:{TRACKER_PORT}")
-        while True:
-            connection, _ = server_socket.accept()
-            threading.Thread(target=handle_peer_connection, args=(connection,), daemon=True).start()
+async def start_tracker():
+    server = await asyncio.start_server(handle_peer_connection, TRACKER_HOST, TRACKER_PORT, reuse_address=True)
+    print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Tracker online at {TRACKER_HOST}:{TRACKER_PORT}")
+    async with server:
+        await asyncio.gather(server.serve_forever(), remove_inactive_peers())
 
 if __name__ == "__main__":
-    start_tracker()
+    asyncio.run(start_tracker())
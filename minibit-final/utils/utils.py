@@ -1,23 +1,152 @@
 # utils/utils.py
 
 import os
+import socket
+import struct
+
+# Message types of the peer wire protocol
+MSG_LIST = 1                 # ask for the block list (empty payload)
+MSG_BLOCK_LIST = 2           # bitfield of held blocks, see pack_bitfield
+MSG_BLOCK_REQUEST = 3        # JSON {'block_id', 'requester_port'}
+MSG_BLOCK_REQUEST_BATCH = 4  # JSON {'block_ids', 'requester_port'}, one reply frame per id
+MSG_BLOCK = 5                # raw block bytes
+MSG_CHOKED = 6               # empty payload
+
+# Message types of the tracker protocol
+MSG_ANNOUNCE = 7             # 16-bit port of the announcing peer
+MSG_PEERS = 8                # peer ports, see pack_ports
+
+# Precompiled formats of the fixed-size protocol fields
+FRAME_HEADER = struct.Struct('>BI')  # message type, payload length
+PORT = struct.Struct('>H')
+
+# Largest payload accepted from the wire: far more than a block batch or the bitfield of any
+# file we serve, but small enough that a forged length can't make us allocate gigabytes.
+MAX_FRAME = 1 << 20
+
+COPY_CHUNK = 1 << 16  # bytes per read when sendfile() can't be used
 
 def partition_file(source_path, destination_folder, segment_size):
     """Split file into fixed-size blocks."""
     os.makedirs(destination_folder, exist_ok=True)
+    buffer = bytearray(segment_size)  # reused for every block
+    view = memoryview(buffer)
     with open(source_path, 'rb') as source_file:
         block_index = 0
-        while data_chunk := source_file.read(segment_size):
+        while chunk_size := source_file.readinto(buffer):
             block_path = f"{destination_folder}/{os.path.basename(source_path)}_block_{block_index}"
             with open(block_path, 'wb') as block_file:
-                block_file.write(data_chunk)
+                block_file.write(view[:chunk_size])
             block_index += 1
     return block_index  # total number of blocks
 
+def _append_file(source_file, result_file):
+    """Append source_file to result_file inside the kernel when sendfile() allows it."""
+    size = os.fstat(source_file.fileno()).st_size
+    offset = 0
+    if hasattr(os, 'sendfile'):  # missing on e.g. Windows
+        try:
+            while offset < size:
+                sent = os.sendfile(result_file.fileno(), source_file.fileno(), offset, size - offset)
+                if not sent:
+                    break
+                offset += sent
+        except OSError:
+            pass  # file-to-file sendfile() is Linux-only
+    # Copy whatever is left through Python; result_file is unbuffered, so writes may be short.
+    source_file.seek(offset)
+    while chunk := source_file.read(COPY_CHUNK):
+        view = memoryview(chunk)
+        while view:
+            view = view[result_file.write(view):]
+
 def assemble_file(block_numbers, source_folder, output_path, file_name):
     """Rebuild original file from blocks."""
-    with open(output_path, 'wb') as result_file:
+    # Unbuffered, so nothing is pending in Python when sendfile() writes to the fd.
+    with open(output_path, 'wb', buffering=0) as result_file:
         for index in sorted(block_numbers):
             block_path = f"{source_folder}/{file_name}_block_{index}"
             with open(block_path, 'rb') as block_file:
-                result_file.write(block_file.read())
+                _append_file(block_file, result_file)
+
+def recv_exact(sock, size):
+    """Read exactly size bytes from a socket; None if it closes first."""
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        count = sock.recv_into(view[received:])
+        if not count:
+            return None
+        received += count
+    return buffer
+
+def tune_socket(sock, min_buffer=None):
+    """Disable Nagle (frames are already batched) and grow kernel buffers below min_buffer bytes, if given."""
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    if min_buffer is None:
+        return
+    for option in (socket.SO_SNDBUF, socket.SO_RCVBUF):
+        if sock.getsockopt(socket.SOL_SOCKET, option) < min_buffer:
+            sock.setsockopt(socket.SOL_SOCKET, option, min_buffer)
+
+def pack_frame(msg_type, payload=b''):
+    """Build a frame: 1-byte message type, 4-byte big-endian length, payload."""
+    return FRAME_HEADER.pack(msg_type, len(payload)) + payload
+
+def send_frame(sock, msg_type, payload=b''):
+    """Send one frame; header and payload are gathered by sendmsg() where the platform has it."""
+    header = FRAME_HEADER.pack(msg_type, len(payload))
+    if not hasattr(sock, 'sendmsg'):  # e.g. Windows
+        sock.sendall(header + payload)
+        return
+    buffers = [memoryview(header), memoryview(payload)]
+    while buffers:
+        sent = sock.sendmsg(buffers)
+        while buffers and sent >= len(buffers[0]):
+            sent -= len(buffers[0])
+            buffers.pop(0)
+        if sent:
+            buffers[0] = buffers[0][sent:]
+
+def recv_frame(sock):
+    """Receive one frame as (msg_type, payload); None if the connection closed, ConnectionError if oversized."""
+    header = recv_exact(sock, FRAME_HEADER.size)
+    if header is None:
+        return None
+    msg_type, length = FRAME_HEADER.unpack(header)
+    if length > MAX_FRAME:
+        raise ConnectionError(f'frame of {length} bytes exceeds MAX_FRAME')
+    payload = recv_exact(sock, length)
+    if payload is None:
+        return None
+    return msg_type, payload
+
+def send_file_frame(sock, msg_type, file):
+    """Send a frame whose payload is the whole file, copied by the kernel with sendfile()."""
+    size = os.fstat(file.fileno()).st_size
+    sock.sendall(FRAME_HEADER.pack(msg_type, size))
+    if sock.sendfile(file, 0, size) != size:
+        raise OSError(f'{file.name} changed while being sent')
+
+def pack_bitfield(blocks, total_blocks):
+    """Encode block ids as a bitfield, most significant bit first (BitTorrent order)."""
+    bitfield = bytearray((total_blocks + 7) // 8)
+    for block in blocks:
+        bitfield[block >> 3] |= 0x80 >> (block & 7)
+    return bytes(bitfield)
+
+# Offsets of the set bits in every possible bitfield byte, most significant bit first
+_BYTE_BITS = [tuple(bit for bit in range(8) if byte & (0x80 >> bit)) for byte in range(256)]
+
+def unpack_bitfield(bitfield):
+    """Decode a bitfield built by pack_bitfield into a set of block ids."""
+    return {index * 8 + bit for index, byte in enumerate(bitfield) for bit in _BYTE_BITS[byte]}
+
+def pack_ports(ports):
+    """Encode peer ports as a 1-byte count followed by 16-bit ports."""
+    return struct.pack(f'>B{len(ports)}H', len(ports), *ports)
+
+def unpack_ports(payload):
+    """Decode a payload built by pack_ports."""
+    return list(struct.unpack_from(f'>{payload[0]}H', payload, 1))